@@ -16,17 +16,38 @@
 #    along with nomspectra.  If not, see <http://www.gnu.org/licenses/>.
 
 from typing import Optional, Tuple
-import copy
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import os
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from scipy.signal import savgol_filter
-from scipy.interpolate import interp1d
+from scipy.signal import savgol_coeffs, fftconvolve
 import scipy.stats as st
 
 from .brutto import gen_from_brutto
 from .spectrum import Spectrum
 
+#common neutral mass loses for mass difference map: CH2, CO, CH2O, C2HO, H2O, CO2
+_MD_DIFF_BRUTTO = pd.DataFrame({'C':[1,1,1,2,0,1],
+                                'H':[2,0,2,1,2,0],
+                                'O':[0,1,1,1,1,2]})
+
+#Savitzky-Golay smoothing of fitted kernel: window 31, polyorder 3
+_SG_WINDOW = 31
+_SG_COEF = savgol_coeffs(_SG_WINDOW, 3)
+#polynomial fit of first window for edge points, same as mode='interp'
+_SG_VANDER = np.vander(np.arange(_SG_WINDOW), 4)
+_SG_EDGE = _SG_VANDER[:_SG_WINDOW // 2] @ np.linalg.pinv(_SG_VANDER)
+
+def _cols(spec: "Spectrum", *names: str) -> Tuple[np.array, ...]:
+    """
+    Take columns of spectrum table as numpy arrays
+    """
+
+    return tuple(spec.table[n].to_numpy() for n in names)
+
+
 def recallibrate(spec: "Spectrum", 
                 error_table: Optional["ErrorTable"] = None, 
                 how: str = 'assign',
@@ -72,7 +93,7 @@ def recallibrate(spec: "Spectrum",
             etalon = Spectrum.read_csv(filename=how)
             error_table = ErrorTable().etalon_error(spec=spec, etalon=etalon, show_map=draw)
 
-    err = copy.deepcopy(error_table.table)
+    err = error_table.table
     spec.table = spec.table.reset_index(drop=True)
     wide = len(err)
 
@@ -80,17 +101,166 @@ def recallibrate(spec: "Spectrum",
     max_mass = err['mass'].max()
     a = np.linspace(min_mass, max_mass, wide+1)
 
-    for i in range(wide):
-        for ind in spec.table.loc[(spec.table['mass']>a[i]) & (spec.table['mass']<=a[i+1])].index:
-            mass = spec.table.loc[ind, 'mass']
-            e = mass * err.loc[i, 'ppm'] / 1000000
-            spec.table.loc[ind, 'mass'] = spec.table.loc[ind, 'mass'] + e
+    #bin i holds masses in (a[i], a[i+1]], masses out of the bins are not changed
+    masses, = _cols(spec, 'mass')
+    masses = masses.astype(float, copy=False)
+    bin_idx = np.digitize(masses, a, right=True) - 1
+    in_bins = (bin_idx >= 0) & (bin_idx < wide)
+    ppm_arr = err['ppm'].to_numpy()[np.clip(bin_idx, 0, wide-1)]
+    masses = np.where(in_bins, masses * (1 + ppm_arr / 1000000), masses)
+    spec.table['mass'] = masses
 
     spec.metadata.add({'recallibrate':how})
 
     return spec
 
 
+@lru_cache(maxsize=None)
+def _md_dif() -> np.array:
+    """
+    Sorted 1-9 times of mass loses from _MD_DIFF_BRUTTO, calculated once
+    """
+
+    dif_masses = gen_from_brutto(_MD_DIFF_BRUTTO.copy())['calc_mass'].values
+    dif = np.unique((dif_masses[:, None] * np.arange(1, 10)[None, :]).ravel())
+    dif.flags.writeable = False
+
+    return dif
+
+
+def _md_error(masses: np.array,
+              query: np.array,
+              dif: np.array,
+              ppm: float) -> Tuple[np.array, np.array]:
+    """
+    Error in ppm of nearest peaks in masses for every query mass plus every dif
+
+    Return query masses and ppm errors of found pairs
+    """
+
+    mz = query[:, None] + dif[None, :]
+
+    #nearest peak in spectrum for every mz, out of range mz get edge peaks
+    last = len(masses) - 1
+    idx = np.clip(np.searchsorted(masses, mz, side='left'), 1, max(last, 1))
+    left = masses.take(idx - 1)
+    right = masses.take(idx, mode='clip')
+    nearest = np.where(np.fabs(mz - left) < np.fabs(mz - right), left, right)
+
+    err_ppm = (nearest - mz) / mz * 1000000
+    mask = np.fabs(err_ppm) <= ppm
+
+    return np.repeat(query, mask.sum(axis=1)), err_ppm[mask]
+
+
+def _savgol_smooth(y: np.array) -> np.array:
+    """
+    Savitzky-Golay filter with precalculated coefficients
+
+    Same as savgol_filter(y, 31, 3), y should be not shorter than 31
+    """
+
+    y = np.asarray(y, dtype=float)
+    return np.concatenate([_SG_EDGE @ y[:_SG_WINDOW],
+                           np.convolve(y, _SG_COEF, mode='valid'),
+                           _SG_EDGE[::-1, ::-1] @ y[-_SG_WINDOW:]])
+
+
+def _exact_kde(x: np.array,
+               y: np.array,
+               xlim: Tuple[float, float],
+               ylim: Tuple[float, float],
+               size: int = 100) -> np.array:
+    """
+    Gaussian kernel density evaluated in every point of regular grid size*size
+
+    Points are split by chunks and evaluated in thread pool.
+    Values are density in points of np.mgrid[xmin:xmax:size*1j, ymin:ymax:size*1j]
+    """
+
+    xx, yy = np.mgrid[xlim[0]:xlim[1]:size*1j, ylim[0]:ylim[1]:size*1j]
+    positions = np.vstack([xx.ravel(), yy.ravel()])
+    kernel = st.gaussian_kde(np.vstack([x, y]))
+    chunks = np.array_split(positions, os.cpu_count() or 1, axis=1)
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        values = np.concatenate(list(executor.map(kernel, chunks)))
+
+    return np.reshape(values.T, xx.shape)
+
+
+def _binned_kde(x: np.array,
+                y: np.array,
+                xlim: Tuple[float, float],
+                ylim: Tuple[float, float],
+                size: int = 100,
+                oversample: int = 4,
+                trunc: float = 4,
+                max_sub: int = 16,
+                floor: float = 1e-6) -> np.array:
+    """
+    Gaussian kernel density on regular grid size*size by binning and FFT convolution
+
+    Bandwidth and covariance are the same as in scipy.stats.gaussian_kde.
+    Data are linear binned on grid with step not bigger than kernel
+    sigma/oversample and convolve with kernel truncated at trunc*sigma,
+    so result is close to gaussian_kde evaluated in grid points.
+    For wide ppm spread difference is about 0.2% of map maximum, for narrow
+    spread (ppm std about 0.05) it grows to 1-2% of maximum.
+    If kernel is so narrow that grid step must be divided more than max_sub
+    times, fine grid takes too much memory and density is evaluated exactly.
+    Density is also evaluated exactly if some mass column of map is empty,
+    as it is for wide gap in masses.
+    Values are density in points of np.mgrid[xmin:xmax:size*1j, ymin:ymax:size*1j],
+    values less than floor*maximum are FFT rounding noise and set to zero
+    """
+
+    cov = st.gaussian_kde(np.vstack([x, y])).covariance
+    sigma = np.sqrt(np.diag(cov))
+    step = np.array([xlim[1] - xlim[0], ylim[1] - ylim[0]]) / (size - 1)
+
+    #fine grid with padding for kernel tails
+    sub = np.maximum(1, np.ceil(oversample * step / sigma)).astype(int)
+    if sub.max() > max_sub:
+        return _exact_kde(x, y, xlim, ylim, size=size)
+    step = step / sub
+    pad = np.ceil(trunc * sigma / step).astype(int)
+    inner = (size - 1) * sub + 1
+    shape = inner + 2 * pad
+
+    #linear binning
+    pos = np.vstack([(x - xlim[0]) / step[0], (y - ylim[0]) / step[1]]) + pad[:, None]
+    base = np.floor(pos).astype(int)
+    frac = pos - base
+    hist = np.zeros(shape[0] * shape[1])
+    for dx in (0, 1):
+        for dy in (0, 1):
+            ix = base[0] + dx
+            iy = base[1] + dy
+            w = (frac[0] if dx else 1 - frac[0]) * (frac[1] if dy else 1 - frac[1])
+            ok = (ix >= 0) & (ix < shape[0]) & (iy >= 0) & (iy < shape[1])
+            hist += np.bincount(ix[ok] * shape[1] + iy[ok], weights=w[ok], minlength=len(hist))
+    hist = hist.reshape(shape)
+
+    #gaussian kernel with full covariance
+    kx = np.arange(-pad[0], pad[0] + 1) * step[0]
+    ky = np.arange(-pad[1], pad[1] + 1) * step[1]
+    kx, ky = np.meshgrid(kx, ky, indexing='ij')
+    inv = np.linalg.inv(cov)
+    kern = np.exp(-0.5 * (inv[0, 0] * kx**2 + 2 * inv[0, 1] * kx * ky + inv[1, 1] * ky**2))
+    kern = kern / (2 * np.pi * np.sqrt(np.linalg.det(cov)) * len(x))
+
+    #single precision FFT is enough for density, result is returned in float64
+    dens = fftconvolve(hist.astype(np.float32), kern.astype(np.float32), mode='same')
+    dens = dens[pad[0]:pad[0] + inner[0]:sub[0], pad[1]:pad[1] + inner[1]:sub[1]]
+
+    dens[dens < floor * dens.max()] = 0
+    #wide gap in masses leaves columns out of truncated kernel, fit_kernel needs tails there
+    if not dens.any(axis=1).all():
+        return _exact_kde(x, y, xlim, ylim, size=size)
+
+    return dens.astype(float)
+
+
 class ErrorTable(object):
     """
     A class used to recallibrate mass spectrum
@@ -135,39 +305,19 @@ class ErrorTable(object):
         Pandas Dataframe
         '''
 
-        #common neutral mass loses: CH2, CO, CH2O, C2HO, H2O, CO2
-        df = pd.DataFrame({ 'C':[1,1,1,2,0,1],
-                            'H':[2,0,2,1,2,0],
-                            'O':[0,1,1,1,1,2]})
-
-        dif_masses = gen_from_brutto(df)['calc_mass'].values
-        dif = np.unique([dif_masses*i for i in range(1,10)])
-
-        data = copy.deepcopy(spec.table)
-        masses = data['mass'].values
+        dif = _md_dif()
 
-        data = data.sort_values(by='intensity', ascending=False).reset_index(drop=True)
-        if len(data) > 1000:
-            data = data[:1000]
-        data = data.sort_values(by='mass').reset_index(drop=True)
+        masses, intensity = _cols(spec, 'mass', 'intensity')
 
-        data_error = [] #array for new data
+        #take 1000 most intensive peaks sorted by mass
+        query = masses
+        if len(masses) > 1000:
+            query = masses[np.argpartition(-intensity, 999)[:1000]]
+        query = np.sort(query)
 
-        for index, row in data.iterrows(): #take every mass in list
-            
-            mass = row["mass"]
+        mass_hits, ppm_hits = _md_error(masses, query, dif, ppm)
 
-            for i in dif:
-                mz = mass + i #massdif
-
-                idx = np.searchsorted(masses, mz, side='left')                
-                if idx > 0 and (idx == len(masses) or np.fabs(mz - masses[idx - 1]) < np.fabs(mz - masses[idx])):
-                    idx -= 1
-
-                if np.fabs(masses[idx] - mz) / mz * 1e6 <= ppm:
-                    data_error.append([mass, (masses[idx] - mz)/mz*1000000])
-        
-        df_error = pd.DataFrame(data = data_error, columns=['mass', 'ppm' ])
+        df_error = pd.DataFrame({'mass': mass_hits, 'ppm': ppm_hits}, copy=False)
 
         return df_error
     
@@ -193,17 +343,23 @@ class ErrorTable(object):
         Pandas Dataframe
         '''
 
-        df = pd.DataFrame(f, index=np.linspace(err_ppm,-err_ppm,100))
-
-        out = []
-        for i in df.columns:
-            max_kernel = df[i].quantile(q=0.95)
-            ppm = df.loc[df[i] > max_kernel].index.values
-            out.append([i, np.mean(ppm)])
-        kde_err = pd.DataFrame(data=out, columns=['i','ppm'])
+        #float32 is enough for density and ppm precision of map
+        f = np.asarray(f, dtype=np.float32)
+        rows = np.linspace(err_ppm, -err_ppm, len(f), dtype=np.float32)
+
+        #mean ppm of points above 0.95 quantile in every column,
+        #quantile with linear interpolation by two partitioned order statistics
+        pos = 0.95 * (len(f) - 1)
+        k = int(np.floor(pos))
+        k_next = min(k + 1, len(f) - 1)
+        part = np.partition(f, [k, k_next], axis=0)
+        max_kernel = part[k] + (pos - k) * (part[k_next] - part[k])
+        mask = f > max_kernel[None, :]
+        ppm = (mask * rows[:, None]).sum(axis=0) / mask.sum(axis=0)
+        kde_err = pd.DataFrame({'i': np.arange(f.shape[1]), 'ppm': ppm})
         
         #smooth data
-        kde_err['ppm'] = savgol_filter(kde_err['ppm'], 31,3)
+        kde_err['ppm'] = _savgol_smooth(kde_err['ppm'])
         
         xmin = min(mass)
         xmax = max(mass)
@@ -218,7 +374,7 @@ class ErrorTable(object):
             ax = fig.gca()
             ax.set_xlim(xmin, xmax)
             ax.set_ylim(ymin, ymax)
-            ax.imshow(df, extent=[xmin, xmax, ymin, ymax], aspect='auto')
+            ax.imshow(f, extent=[xmin, xmax, ymin, ymax], aspect='auto')
             ax.plot(kde_err['mass'], kde_err['ppm'], c='r')
             ax.set_xlabel('m/z, Da')
             ax.set_ylabel('error, ppm')      
@@ -229,6 +385,7 @@ class ErrorTable(object):
     def kernel_density_map(
         df_error: pd.DataFrame, 
         ppm: float = 3, 
+        exact: bool = False,
         ) -> np.array:
         '''
         Calculate and plot kernel density map 100*100 for data
@@ -240,6 +397,10 @@ class ErrorTable(object):
         ppm: float
             Optional. Default 3.
             treshould for generate
+        exact: bool
+            Optional. Default False - fast calculation by binning and FFT.
+            If True evaluate gaussian kde in every point of map by chunks
+            in thread pool, it is much slower
         show_map: bool
             Optional. Default False. plot kde
 
@@ -257,12 +418,10 @@ class ErrorTable(object):
         ymin = -ppm 
         ymax = ppm 
 
-        xx, yy = np.mgrid[xmin:xmax:100j, ymin:ymax:100j]
-
-        positions = np.vstack([xx.ravel(), yy.ravel()])
-        values = np.vstack([x, y])
-        kernel = st.gaussian_kde(values)
-        kdm = np.reshape(kernel(positions).T, xx.shape)
+        if exact:
+            kdm = _exact_kde(x, y, (xmin, xmax), (ymin, ymax), size=100)
+        else:
+            kdm = _binned_kde(x, y, (xmin, xmax), (ymin, ymax), size=100)
         kdm = np.rot90(kdm)
         
         return kdm
@@ -295,21 +454,21 @@ class ErrorTable(object):
         ErrorTable
         '''
 
-        spectr = copy.deepcopy(spec)
+        #assign uses only mass and intensity and don't change initial table
+        spectr = Spectrum(table=spec.table.loc[:, ['mass', 'intensity']])
         spectr = spectr.assign(rel_error=ppm, brutto_dict=brutto_dict, sign=mode)
         spectr = spectr.calc_mass().calc_error()
 
-        error_table = spectr.table
-        error_table = error_table.loc[:,['mass','rel_error']]
-        error_table.columns = ['mass', 'ppm']
-        error_table['ppm'] = - error_table['ppm']
+        assigned_mass, rel_error, assigned = _cols(spectr, 'mass', 'rel_error', 'assign')
+        error_table = pd.DataFrame({'mass': assigned_mass, 'ppm': - rel_error})
         error_table = error_table.dropna()
 
         kdm = ErrorTable.kernel_density_map(df_error = error_table)
         err = ErrorTable.fit_kernel(f=kdm, 
                             show_map=show_map, 
-                            mass=spectr.drop_unassigned().table['mass'].values)
-        err = ErrorTable(err).extrapolate((spec.table['mass'].min(), spec.table['mass'].max()))
+                            mass=assigned_mass[assigned == True])
+        mass, = _cols(spec, 'mass')
+        err = ErrorTable(err).extrapolate((np.nanmin(mass), np.nanmax(mass)))
 
         return err
 
@@ -338,15 +497,16 @@ class ErrorTable(object):
         Analytical chemistry, 91(5), 3350-3358. 
         '''
 
-        spec = copy.deepcopy(spec)
+        mass, = _cols(spec, 'mass')
         mde = ErrorTable.md_error_map(spec = spec)
         kdm = ErrorTable.kernel_density_map(df_error=mde)
-        err = ErrorTable.fit_kernel(f=kdm, show_map=show_map, mass=spec.table['mass'].values)
+        err = ErrorTable.fit_kernel(f=kdm, show_map=show_map, mass=mass)
         
-        err = ErrorTable(err)
-        err.table['ppm'] = err.table['ppm'] - err.table.loc[0, 'ppm']
+        #shift error to zero at first mass
+        ppm = err['ppm'].to_numpy()
+        err['ppm'] = ppm - ppm[0]
 
-        return err
+        return ErrorTable(err)
 
     @staticmethod
     def etalon_error(spec: "Spectrum", #initial masspectr
@@ -379,39 +539,31 @@ class ErrorTable(object):
         ErrorTable
         '''
 
-        et = copy.deepcopy(etalon.table)['mass'].to_list()
-        df = copy.deepcopy(spec.table)
-
-        min_mass = df['mass'].min()
-        max_mass = df['mass'].max()
-        a = np.linspace(min_mass,max_mass,101)
-
-        treshold = df['intensity'].quantile(quart)
-        df = df.loc[df['intensity'] > treshold].reset_index(drop = True)
-        df['cal'] = 0 #column for check
-
-        #fill data massiv with correct mass
-        for i in range(0,len(df)):
-            min_mass = df.loc[i, 'mass']*(1 - ppm/1000000)
-            max_mass = df.loc[i, 'mass']*(1 + ppm/1000000)
-            for mass in et:
-                try:
-                    if mass > min_mass and mass < max_mass:
-                        df.loc[i, 'cal'] = mass
-                except:
-                    pass
-        
+        et, = _cols(etalon, 'mass')
+        mass, intensity = _cols(spec, 'mass', 'intensity')
+
+        treshold = np.nanquantile(intensity, quart)
+        m_arr = mass[intensity > treshold]
+
+        #fill data massiv with correct mass, largest etalon mass in ppm window
+        et = np.sort(np.asarray(et, dtype=float))
+        et = et[~np.isnan(et)]
+        lo = np.searchsorted(et, m_arr*(1 - ppm/1000000), side='right')
+        hi = np.searchsorted(et, m_arr*(1 + ppm/1000000), side='left')
+        cal = np.zeros(len(m_arr)) #column for check
+        found = hi > lo
+        cal[found] = et[hi[found] - 1]
+
         # take just assigned peaks
-        df = df.loc[df['cal']>0]
+        m_arr = m_arr[found]
+        cal = cal[found]
         #calc error and mean error
-        df['dif'] = df['cal'] - df['mass']
-        df['ppm']=df['dif']/df['mass']*1000000
-
-        error_table = df.loc[:,['mass','ppm']]
+        dif = cal - m_arr
+        error_table = pd.DataFrame({'mass': m_arr, 'ppm': dif/m_arr*1000000})
         error_table = error_table.dropna()
 
         kdm = ErrorTable.kernel_density_map(df_error = error_table)
-        err = ErrorTable.fit_kernel(f=kdm, show_map=show_map, mass=spec.table['mass'].values)
+        err = ErrorTable.fit_kernel(f=kdm, show_map=show_map, mass=mass)
 
         return ErrorTable(err)
 
@@ -434,11 +586,24 @@ class ErrorTable(object):
             ranges = [self.table['mass'].min(), self.table['mass'].max()]
 
         interpolation_range = np.linspace(ranges[0], ranges[1], 100)
-        linear_interp = interp1d(self.table['mass'], self.table['ppm'],  bounds_error=False, fill_value='extrapolate')
-        linear_results = linear_interp(interpolation_range)
-        err = pd.DataFrame()
-        err ['mass'] = interpolation_range
-        err ['ppm'] = linear_results
+        mass_arr = self.table['mass'].to_numpy(dtype=float)
+        ppm_arr = self.table['ppm'].to_numpy(dtype=float)
+        order = np.argsort(mass_arr, kind='stable')
+        mass_arr = mass_arr[order]
+        ppm_arr = ppm_arr[order]
+
+        linear_results = np.interp(interpolation_range, mass_arr, ppm_arr)
+
+        #linear extrapolation by two edge points out of mass range
+        left_slope = (ppm_arr[1] - ppm_arr[0]) / (mass_arr[1] - mass_arr[0])
+        right_slope = (ppm_arr[-1] - ppm_arr[-2]) / (mass_arr[-1] - mass_arr[-2])
+        linear_results = np.where(interpolation_range < mass_arr[0],
+                                  ppm_arr[0] + left_slope * (interpolation_range - mass_arr[0]),
+                                  linear_results)
+        linear_results = np.where(interpolation_range > mass_arr[-1],
+                                  ppm_arr[-1] + right_slope * (interpolation_range - mass_arr[-1]),
+                                  linear_results)
+        err = pd.DataFrame({'mass': interpolation_range, 'ppm': linear_results})
 
         return ErrorTable(err)
 
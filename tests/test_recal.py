@@ -4,6 +4,7 @@ import pytest
 import os
 import numpy as np
 import pandas as pd
+import scipy.stats as st
 import matplotlib.pyplot as plt
 plt.rcParams.update({'figure.max_open_warning': 0})
 
@@ -51,6 +52,43 @@ class Test_ErrorTable:
         assert len(f) == 100
         assert round(np.mean(f[50,:]),3) == 0.013
 
+    def test_kernel_density_map_exact(self):
+        et = ErrorTable.md_error_map(spec1)
+        f = ErrorTable.kernel_density_map(et)
+        f_exact = ErrorTable.kernel_density_map(et, exact=True)
+        assert f.shape == f_exact.shape
+        assert (f >= 0).all()
+        #1% holds for wide ppm spread of md_error_map, narrow spread gives up to 2%
+        assert np.abs(f - f_exact).max() < 0.01 * f_exact.max()
+
+    @pytest.mark.parametrize('std', [0.005, 0.02, 0.05])
+    def test_kernel_density_map_narrow_fit(self, std):
+        rng = np.random.default_rng(0)
+        et = pd.DataFrame({'mass':rng.uniform(200, 800, 1000),
+                           'ppm':rng.normal(0.3, std, 1000)})
+        f = ErrorTable.kernel_density_map(et)
+        f_exact = ErrorTable.kernel_density_map(et, exact=True)
+        fit = ErrorTable.fit_kernel(f, mass=et['mass'].values, show_map=False)
+        fit_exact = ErrorTable.fit_kernel(f_exact, mass=et['mass'].values, show_map=False)
+        np.testing.assert_allclose(fit['ppm'], fit_exact['ppm'], atol=0.01)
+
+    def test_kernel_density_map_mass_gap(self):
+        rng = np.random.default_rng(0)
+        et = pd.DataFrame({'mass':np.concatenate([rng.uniform(200, 210, 4000),
+                                                  rng.uniform(980, 1000, 4000)]),
+                           'ppm':rng.normal(0.5, 0.3, 8000)})
+        f = ErrorTable.kernel_density_map(et)
+        fit = ErrorTable.fit_kernel(f, mass=et['mass'].values, show_map=False)
+        assert not fit['ppm'].isna().any()
+
+    def test_kernel_density_map_exact_values(self):
+        et = ErrorTable.md_error_map(spec1)[:500]
+        f = ErrorTable.kernel_density_map(et, exact=True)
+        xx, yy = np.mgrid[et['mass'].min():et['mass'].max():100j, -3:3:100j]
+        kernel = st.gaussian_kde(np.vstack([et['mass'], et['ppm']]))
+        f_serial = np.rot90(kernel(np.vstack([xx.ravel(), yy.ravel()])).reshape(xx.shape))
+        np.testing.assert_allclose(f, f_serial)
+
     def test_fit_kernel(self):
         et = ErrorTable.md_error_map(spec1)
         f = ErrorTable.kernel_density_map(et)
@@ -69,6 +107,22 @@ class Test_ErrorTable:
         et = ErrorTable.etalon_error(spec1, spec2)
         assert round(et.table['ppm'].mean(),6) == -0.069091
 
+    def test_error_not_change_spec(self):
+        spec = spec2.copy()
+        ErrorTable.assign_error(spec, show_map=False)
+        ErrorTable.massdiff_error(spec, show_map=False)
+        ErrorTable.etalon_error(spec, spec1, show_map=False)
+        pd.testing.assert_frame_equal(spec.table, spec2.table)
+
+    def test_etalon_error_nan_mass(self):
+        etalon = spec2.copy()
+        nan_rows = etalon.table.index[::2]
+        etalon.table.loc[nan_rows, 'mass'] = np.nan
+        etalon_dropped = Spectrum(table=etalon.table.drop(index=nan_rows))
+        et_nan = ErrorTable.etalon_error(spec1, etalon, show_map=False)
+        et = ErrorTable.etalon_error(spec1, etalon_dropped, show_map=False)
+        pd.testing.assert_frame_equal(et_nan.table, et.table)
+
     def test_extrapolate(self):
         df = pd.DataFrame({'mass':[400,500],'ppm':[0,1]})
         et = ErrorTable(df)